@@ -1,197 +1,341 @@
 #!/usr/bin/env python3
 
-import argparse, sys, re, enum, io
-from typing import BinaryIO, Tuple, List
+import argparse, sys, re, os, tempfile, zipfile
+from typing import BinaryIO, TextIO, Optional, Tuple, List
 from math import cos, sin, pi
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
 
-class RecordType(enum.Enum):
-    position, normal, texcoord, triangle = range(4)
+_COMMENT_PATTERN = re.compile(rb'#[^\n]*')
+_CORNER_PATTERN = re.compile(rb'(-?\d+)(?:/-?\d*)*')
+_VERTEX_FORMAT = 'v {:.7f} {:.7f} {:.7f}\nvn {:.7f} {:.7f} {:.7f}\nvt {:.7f} {:.7f}\n'.format
+_TRIANGLE_FORMAT = 'f {0}/{0}/{0} {1}/{1}/{1} {2}/{2}/{2}\n'.format
+_DUMP_CHUNK_SIZE = 1 << 16
+_CACHE_VERSION = 1
 
-class VertexObject(object):
-    def __init__(self):
-        self.position:tuple[float, float, float] = (0, 0, 0)
-        self.normal:tuple[float, float, float] = (0, 0, 0)
-        self.texcoord:tuple[float, float] = (0, 0)
-        self.index:int = 0
+if numba:
+    @numba.njit(cache=True)
+    def _is_space(char:int)->bool:
+        return char == 32 or 9 <= char <= 13
+
+    @numba.njit(cache=True)
+    def _scan_number(data:np.ndarray, i:int, end:int):
+        negative = False
+        if i < end and (data[i] == 43 or data[i] == 45):
+            negative = data[i] == 45
+            i += 1
+        mantissa, exponent, digits, overflow = 0, 0, 0, False
+        while i < end and 48 <= data[i] <= 57:
+            if mantissa < 100000000000000000: mantissa = mantissa * 10 + (data[i] - 48)
+            else: overflow = True
+            digits += 1
+            i += 1
+        if i < end and data[i] == 46:
+            i += 1
+            while i < end and 48 <= data[i] <= 57:
+                if mantissa < 100000000000000000: mantissa = mantissa * 10 + (data[i] - 48)
+                else: overflow = True
+                exponent -= 1
+                digits += 1
+                i += 1
+        if digits and i < end and (data[i] == 69 or data[i] == 101):
+            i += 1
+            sign, power, power_digits = 1, 0, 0
+            if i < end and (data[i] == 43 or data[i] == 45):
+                if data[i] == 45: sign = -1
+                i += 1
+            while i < end and 48 <= data[i] <= 57:
+                if power < 100000: power = power * 10 + (data[i] - 48)
+                power_digits += 1
+                i += 1
+            if not power_digits: digits = 0
+            exponent += sign * power
+        # exact only on the Clinger fast path: mantissa and 10**|exponent| are both exact doubles
+        exact = digits > 0 and not overflow and mantissa <= 9007199254740992 and -22 <= exponent <= 22
+        value = float(mantissa)
+        if exponent < 0: value /= 10.0 ** -exponent
+        elif exponent > 0: value *= 10.0 ** exponent
+        return -value if negative else value, i, exact
+
+    @numba.njit(cache=True)
+    def _scan_index(data:np.ndarray, i:int, end:int):
+        negative = i < end and data[i] == 45
+        if negative: i += 1
+        value, digits = 0, 0
+        while i < end and 48 <= data[i] <= 57 and digits < 18:
+            value = value * 10 + (data[i] - 48)
+            digits += 1
+            i += 1
+        return -value if negative else value, i, digits > 0
+
+    @numba.njit(cache=True)
+    def _grow(array:np.ndarray, size:int)->np.ndarray:
+        grown = np.zeros((max(size * 2, 16), array.shape[1]), dtype=array.dtype)
+        grown[:size] = array[:size]
+        return grown
+
+    @numba.njit(cache=True)
+    def _parse_obj(data:np.ndarray, vertex_capacity:int, triangle_capacity:int):
+        positions = np.zeros((vertex_capacity, 3))
+        normals = np.zeros((vertex_capacity, 3))
+        texcoords = np.zeros((vertex_capacity, 2))
+        triangles = np.empty((triangle_capacity, 3), dtype=np.int32)
+        values = np.zeros(3)
+        corners = np.empty(16, dtype=np.int64)
+        vertex_count, triangle_count = 0, 0
+        i, end = 0, len(data)
+        while i < end:
+            stop = i
+            while stop < end and data[stop] != 10 and data[stop] != 35: stop += 1
+            line_end = stop
+            while line_end < end and data[line_end] != 10: line_end += 1
+            while i < stop and _is_space(data[i]): i += 1
+            tag = i
+            while i < stop and not _is_space(data[i]): i += 1
+            kind = -1
+            if i - tag == 1 and data[tag] == 118: kind = 0
+            elif i - tag == 2 and data[tag] == 118 and data[tag + 1] == 110: kind = 1
+            elif i - tag == 2 and data[tag] == 118 and data[tag + 1] == 116: kind = 2
+            elif i - tag == 1 and data[tag] == 102: kind = 3
+            count = 0
+            while kind >= 0:
+                while i < stop and _is_space(data[i]): i += 1
+                if i >= stop: break
+                if kind == 3:
+                    index, i, valid = _scan_index(data, i, stop)
+                    if not valid or (i < stop and data[i] != 47 and not _is_space(data[i])): return False, positions[:0], normals[:0], texcoords[:0], triangles[:0]
+                    if count == len(corners):
+                        grown = np.empty(count * 2, dtype=np.int64)
+                        grown[:count] = corners
+                        corners = grown
+                    if index < 0: index += vertex_count + 1
+                    if not 1 <= index <= vertex_count: return False, positions[:0], normals[:0], texcoords[:0], triangles[:0]
+                    corners[count] = index - 1
+                    while i < stop and not _is_space(data[i]): i += 1
+                else:
+                    value, i, exact = _scan_number(data, i, stop)
+                    if not exact or (i < stop and not _is_space(data[i])): return False, positions[:0], normals[:0], texcoords[:0], triangles[:0]
+                    if count < 3: values[count] = value
+                count += 1
+            if kind == 0:
+                if vertex_count == len(positions):
+                    positions = _grow(positions, vertex_count)
+                    normals = _grow(normals, vertex_count)
+                    texcoords = _grow(texcoords, vertex_count)
+                positions[vertex_count] = values
+                vertex_count += 1
+            elif kind == 1 and vertex_count and count >= 3:
+                normals[vertex_count - 1] = values
+            elif kind == 2 and vertex_count and count == 2:
+                texcoords[vertex_count - 1] = values[:2]
+            elif kind == 3:
+                for n in range(1, count - 1):
+                    if triangle_count == len(triangles): triangles = _grow(triangles, triangle_count)
+                    triangles[triangle_count, 0] = corners[0]
+                    triangles[triangle_count, 1] = corners[n]
+                    triangles[triangle_count, 2] = corners[n + 1]
+                    triangle_count += 1
+            values[:] = 0
+            i = line_end + 1
+        if vertex_count < len(positions):
+            positions, normals, texcoords = positions[:vertex_count].copy(), normals[:vertex_count].copy(), texcoords[:vertex_count].copy()
+        if triangle_count < len(triangles): triangles = triangles[:triangle_count].copy()
+        return True, positions, normals, texcoords, triangles
 
 class MeshObject(object):
-    def __init__(self, file_path:str):
-        self.triangles:list[tuple[VertexObject, VertexObject, VertexObject]] = []
-        with open(file_path, mode='rb') as fp:
-            self.__load(buffer=fp)
+    def __init__(self, file_path:str, cache:bool = False):
+        self.positions:np.ndarray = np.zeros((0, 3))
+        self.normals:np.ndarray = np.zeros((0, 3))
+        self.texcoords:np.ndarray = np.zeros((0, 2))
+        self.triangles:np.ndarray = np.zeros((0, 3), dtype=np.int32)
+        self.__unique_vertices:Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self.__weld_positions:bool = False
+        cache_path = file_path + '.npz'
+        fresh = cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path)
+        if not (fresh and self.__load_cache(cache_path)):
+            with open(file_path, mode='rb', buffering=0) as fp:
+                self.__load(buffer=fp)
+            if cache: self.__save_cache(cache_path)
+        print('# vertices:{} triangles:{}'.format(len(self.positions), len(self.triangles)))
+
+    def __load_cache(self, cache_path:str)->bool:
+        try:
+            with np.load(cache_path) as data:
+                if 'version' not in data or data['version'] != _CACHE_VERSION: return False
+                positions, normals, texcoords, triangles = data['positions'], data['normals'], data['texcoords'], data['triangles']
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+            return False
+        self.positions, self.normals, self.texcoords, self.triangles = positions, normals, texcoords, triangles
+        return True
+
+    def __save_cache(self, cache_path:str):
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(cache_path) + '.', dir=os.path.dirname(cache_path) or '.')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, mode='wb') as fp:
+                np.savez(fp, version=_CACHE_VERSION, positions=self.positions, normals=self.normals, texcoords=self.texcoords, triangles=self.triangles)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+        finally:
+            if os.path.exists(temp_path): os.remove(temp_path)
 
     def __load(self, buffer:BinaryIO):
-        value, record = b'', []
-        value_type:RecordType = RecordType.position
-        prev = b''
-        vertex:VertexObject = None
-        vertex_idx:int = 0
-        vertex_map:dict[int, VertexObject] = {}
-        while True:
-            char = buffer.read(1)
-            if not char: break
-            if char == b'v': pass
-            elif char == b'n':
-                if prev == b'v': value_type = RecordType.normal
-            elif char == b't':
-                if prev == b'v': value_type = RecordType.texcoord
-            elif char == b'f':
-                if prev == b'\n':value_type = RecordType.triangle
-            elif char in b' \n':
-                if prev == b'v':
-                    vertex_idx += 1
-                    value_type = RecordType.position
-                    vertex = VertexObject()
-                    vertex.index = vertex_idx
-                    vertex_map[vertex.index] = vertex
-                elif prev == b' ':pass
-                else:
-                    if value:
-                        if value_type == RecordType.triangle:
-                            record.append(int(value.split(b'/')[0]))
-                        else:
-                            record.append(float(value))
-                value = b''
-                if char == b'\n':
-                    if value_type == RecordType.normal:
-                        vertex.normal = tuple(record)
-                    elif value_type == RecordType.position:
-                        vertex.position = tuple(record)
-                    elif value_type == RecordType.texcoord:
-                        if len(record) == 2: vertex.texcoord = tuple(record)
-                    elif value_type == RecordType.triangle:
-                        triangle = tuple(vertex_map.get(x) for x in record) # type:tuple[VertexObject,VertexObject,VertexObject]
-                        if triangle: self.triangles.append(triangle)
-                    record = []
-            elif char == b'#':
-                while True:
-                    char = buffer.read(1)
-                    if not char or char == b'\n': break
-            else:
-                value += char
-            prev = char
-        print('# vertices:{} triangles:{}'.format(len(vertex_map), len(self.triangles)))
-
-    def __encode_tuple(self, buffer:io.StringIO, data:Tuple[float, ...]):
-        for value in data: buffer.write(' {:.7f}'.format(value))
-
-    def __get_unique_vertices(self):
-        hash_map = {}
-        vertex_array: list[VertexObject] = []
-        for triangle in self.triangles:
-            for vertex in triangle:
-                uuid = vertex.__hash__()
-                if uuid not in hash_map:
-                    vertex_array.append(vertex)
-                    vertex.index = len(vertex_array)
-                    hash_map[uuid] = vertex
-        return vertex_array
-
-    def __rotate_x(self, angle:float):
-        if angle == 0: return
-        angle = pi / 180 * angle
-        matrix = (
-            1,          0,           0,
-            0, cos(angle), -sin(angle),
-            0, sin(angle),  cos(angle)
+        data = buffer.read()
+        if numba:
+            vertex_count = data.count(b'\nv ') + data.startswith(b'v ')
+            triangle_count = data.count(b'\nf ') + data.startswith(b'f ')
+            parsed, positions, normals, texcoords, triangles = _parse_obj(np.frombuffer(data, dtype=np.uint8), vertex_count, triangle_count)
+            if parsed:
+                self.positions, self.normals, self.texcoords, self.triangles = positions, normals, texcoords, triangles
+                return
+        v_lines:list[bytes] = []
+        vn_lines:list[bytes] = []
+        vt_lines:list[bytes] = []
+        vn_owners:list[int] = []
+        vt_owners:list[int] = []
+        triangles:list[tuple[int, int, int]] = []
+
+        def handle_position(values:bytes):
+            values = values.split()[:3]
+            v_lines.append(b' '.join(values + [b'0'] * (3 - len(values))))
+
+        def handle_normal(values:bytes):
+            values = values.split()
+            if not v_lines or len(values) < 3: return
+            vn_lines.append(b' '.join(values[:3]))
+            vn_owners.append(len(v_lines) - 1)
+
+        def handle_texcoord(values:bytes):
+            if not v_lines or len(values.split()) != 2: return
+            vt_lines.append(values)
+            vt_owners.append(len(v_lines) - 1)
+
+        def resolve_index(value:bytes)->int:
+            index = int(value)
+            if index < 0: index += len(v_lines) + 1
+            if not 1 <= index <= len(v_lines): raise ValueError('face index {} out of range for {} vertices'.format(value.decode(), len(v_lines)))
+            return index - 1
+
+        def handle_triangle(values:bytes):
+            corners = [resolve_index(x) for x in _CORNER_PATTERN.findall(values)]
+            for n in range(1, len(corners) - 1):
+                triangles.append((corners[0], corners[n], corners[n + 1]))
+
+        handlers = {b'v': handle_position, b'vn': handle_normal, b'vt': handle_texcoord, b'f': handle_triangle}
+        data = _COMMENT_PATTERN.sub(b'', data)
+        for line in data.splitlines():
+            tokens = line.split(None, 1)
+            if not tokens: continue
+            handler = handlers.get(tokens[0])
+            if handler: handler(tokens[1] if len(tokens) > 1 else b'')
+        self.positions = self.__parse_floats(v_lines, 3)
+        self.normals = np.zeros((len(self.positions), 3))
+        self.normals[vn_owners] = self.__parse_floats(vn_lines, 3)
+        self.texcoords = np.zeros((len(self.positions), 2))
+        self.texcoords[vt_owners] = self.__parse_floats(vt_lines, 2)
+        self.triangles = np.array(triangles, dtype=np.int32).reshape(-1, 3)
+
+    def __parse_floats(self, lines:List[bytes], width:int)->np.ndarray:
+        if not lines: return np.zeros((0, width))
+        return np.fromstring(b' '.join(lines), sep=' ').reshape(-1, width)
+
+    def __get_unique_vertices(self)->Tuple[np.ndarray, np.ndarray]:
+        if self.__unique_vertices is None: self.__unique_vertices = self.__weld_vertices()
+        return self.__unique_vertices
+
+    def __weld_vertices(self)->Tuple[np.ndarray, np.ndarray]:
+        attributes = self.positions if self.__weld_positions else np.hstack([self.positions, self.normals, self.texcoords])
+        keys = np.round(attributes * 1e5).astype(np.int64)
+        keys = keys.view(np.dtype((np.void, keys.itemsize * keys.shape[1]))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        triangles = first[inverse.ravel()][self.triangles]
+        unique, order = np.unique(triangles, return_index=True)
+        vertex_array = unique[np.argsort(order)]
+        remap = np.zeros(len(self.positions), dtype=np.int32)
+        remap[vertex_array] = np.arange(1, len(vertex_array) + 1)
+        return vertex_array, remap[triangles]
+
+    def __get_rotation_x(self, angle:float)->Optional[Tuple[float, ...]]:
+        if angle == 0: return None
+        c, s = cos(pi / 180 * angle), sin(pi / 180 * angle)
+        return (
+            1, 0,  0,
+            0, c, -s,
+            0, s,  c
         )
-        self.__rotate_with_matrix(matrix)
 
-    def __rotate_y(self, angle:float):
-        if angle == 0: return
-        angle = pi / 180 * angle
-        matrix = (
-             cos(angle), 0, sin(angle),
-                      0, 1,          0,
-            -sin(angle), 0, cos(angle)
+    def __get_rotation_y(self, angle:float)->Optional[Tuple[float, ...]]:
+        if angle == 0: return None
+        c, s = cos(pi / 180 * angle), sin(pi / 180 * angle)
+        return (
+             c, 0, s,
+             0, 1, 0,
+            -s, 0, c
         )
-        self.__rotate_with_matrix(matrix)
 
-    def __rotate_z(self, angle:float):
-        if angle == 0: return
-        angle = pi / 180 * angle
-        matrix = (
-            cos(angle), -sin(angle), 0,
-            sin(angle),  cos(angle), 0,
-                     0,           0, 1
+    def __get_rotation_z(self, angle:float)->Optional[Tuple[float, ...]]:
+        if angle == 0: return None
+        c, s = cos(pi / 180 * angle), sin(pi / 180 * angle)
+        return (
+            c, -s, 0,
+            s,  c, 0,
+            0,  0, 1
         )
-        self.__rotate_with_matrix(matrix)
 
-    def __vector_dot(self, row:Tuple[float, float, float], col:Tuple[float, float, float]):
-        return row[0]*col[0] + row[1]*col[1] + row[2]*col[2]
-
-    def __rotate_with_matrix(self, matrix:Tuple[float, ...]):
-        vertex_array = self.__get_unique_vertices()
-        for vertex in vertex_array:
-            position = vertex.position
-            vertex.position = (
-                self.__vector_dot(matrix[0:3], position),
-                self.__vector_dot(matrix[3:6], position),
-                self.__vector_dot(matrix[6:9], position)
-            )
-            normal = vertex.normal
-            vertex.normal = (
-                self.__vector_dot(matrix[0:3], normal),
-                self.__vector_dot(matrix[3:6], normal),
-                self.__vector_dot(matrix[6:9], normal)
-            )
+    def __rotate_with_matrix(self, matrix:np.ndarray):
+        transposed = matrix.astype(self.positions.dtype).T
+        self.positions = self.positions @ transposed
+        self.normals = self.normals @ transposed
 
     def rotate(self, angles:Tuple[float, float, float]):
-        self.__rotate_x(angles[0])
-        self.__rotate_y(angles[1])
-        self.__rotate_z(angles[2])
+        rotations = (self.__get_rotation_x(angles[0]), self.__get_rotation_y(angles[1]), self.__get_rotation_z(angles[2]))
+        rotations = [np.array(x).reshape(3, 3) for x in rotations if x]
+        if not rotations: return
+        matrix = rotations[0]
+        for rotation in rotations[1:]: matrix = rotation @ matrix
+        self.__rotate_with_matrix(matrix)
 
     def align(self):
-        span_x = [1000000,-1000000]
-        span_y = [1000000,-1000000]
-        span_z = [1000000,-1000000]
-        vertex_array = self.__get_unique_vertices()
-        for vertex in vertex_array:
-            p = vertex.position
-            span_x[0] = min(span_x[0], p[0])
-            span_x[1] = max(span_x[1], p[0])
-            span_y[0] = min(span_y[0], p[1])
-            span_y[1] = max(span_y[1], p[1])
-            span_z[0] = min(span_z[0], p[2])
-            span_z[1] = max(span_z[1], p[2])
-        anchor = ((span_x[0] + span_x[1])/2, span_y[0], (span_z[0] + span_z[1])/2)
-        print('#', span_x, span_y,span_z)
-        print('#', anchor)
-        for vertex in vertex_array:
-            p = vertex.position
-            vertex.position = (
-                p[0] - anchor[0],
-                p[1] - anchor[1],
-                p[2] - anchor[2]
-            )
-
-    def dump(self):
-        buffer:io.StringIO = io.StringIO()
-        vertex_array:list[VertexObject] = self.__get_unique_vertices()
-        for vertex in vertex_array:
-            buffer.write('v')
-            self.__encode_tuple(buffer, vertex.position)
-            buffer.write('\n')
-            if vertex.normal:
-                buffer.write('vn')
-                self.__encode_tuple(buffer, vertex.normal)
-                buffer.write('\n')
-            if vertex.texcoord:
-                buffer.write('vt')
-                self.__encode_tuple(buffer, vertex.texcoord)
-                buffer.write('\n')
-        buffer.write('# {} verticies\n'.format(len(vertex_array)))
-        for triangle in self.triangles:
-            buffer.write('f')
-            for vertex in triangle: buffer.write(' {}/{}/{}'.format(vertex.index, vertex.index, vertex.index))
-            buffer.write('\n')
-        buffer.write('# {} elements\n'.format(len(self.triangles)))
-        buffer.seek(0)
-        return buffer.read()
-
-    def append(self, target: 'MeshObject'):
-        for triangle in target.triangles:
-            self.triangles.append(triangle)
+        vertex_array, _ = self.__get_unique_vertices()
+        if not len(vertex_array): return
+        positions = self.positions[vertex_array]
+        lo, hi = positions.min(axis=0), positions.max(axis=0)
+        anchor = (lo + hi) / 2
+        anchor[1] = lo[1]
+        print('#', *np.stack([lo, hi], axis=1).tolist())
+        print('#', tuple(anchor.tolist()))
+        self.positions -= anchor
+
+    def weld_positions(self):
+        self.__weld_positions = True
+        self.__unique_vertices = None
+
+    def dump(self, out:Optional[TextIO] = None):
+        if out is None: out = sys.stdout
+        vertex_array, triangles = self.__get_unique_vertices()
+        for start in range(0, len(vertex_array), _DUMP_CHUNK_SIZE):
+            chunk = vertex_array[start:start + _DUMP_CHUNK_SIZE]
+            vertices = np.hstack([self.positions[chunk], self.normals[chunk], self.texcoords[chunk]])
+            out.writelines(map(_VERTEX_FORMAT, *vertices.T.tolist()))
+        out.write(f'# {len(vertex_array)} verticies\n')
+        for start in range(0, len(triangles), _DUMP_CHUNK_SIZE):
+            out.writelines(map(_TRIANGLE_FORMAT, *triangles[start:start + _DUMP_CHUNK_SIZE].T.tolist()))
+        out.write(f'# {len(self.triangles)} elements\n')
+
+    def append(self, *targets: 'MeshObject'):
+        meshes = (self,) + targets
+        offsets = np.cumsum([0] + [len(x.positions) for x in meshes[:-1]])
+        self.positions = np.concatenate([x.positions for x in meshes])
+        self.normals = np.concatenate([x.normals for x in meshes])
+        self.texcoords = np.concatenate([x.texcoords for x in meshes])
+        self.triangles = np.concatenate([x.triangles + offset for x, offset in zip(meshes, offsets)]).astype(np.int32)
+        self.__unique_vertices = None
 
 
 if __name__ == '__main__':
@@ -201,14 +345,12 @@ if __name__ == '__main__':
     arguments.add_argument('--rotate-y', '-y', type=float, default=0)
     arguments.add_argument('--rotate-z', '-z', type=float, default=-90)
     arguments.add_argument('--align', '-a', action='store_true', default=False)
+    arguments.add_argument('--cache', '-c', action='store_true', default=False)
+    arguments.add_argument('--weld-positions', '-w', action='store_true', default=False)
     options = arguments.parse_args(sys.argv[1:])
-    mesh:MeshObject = None
-    for item_path in options.obj_file:
-        item = MeshObject(file_path=item_path)
-        if not mesh:
-            mesh = item
-            continue
-        mesh.append(item)
+    mesh, *items = [MeshObject(file_path=x, cache=options.cache) for x in options.obj_file]
+    mesh.append(*items)
+    if options.weld_positions: mesh.weld_positions()
     mesh.rotate(angles=(options.rotate_x,options.rotate_y,options.rotate_z))
     if options.align: mesh.align()
-    print(mesh.dump())
+    mesh.dump(sys.stdout)